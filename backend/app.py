@@ -1,22 +1,61 @@
 import os
-import gc
+from dotenv import load_dotenv
+
+# Load environment variables from .env file. This must happen before model.py is imported,
+# since it reads its CHEXNET_* / TORCH_THREADS settings at import time.
+load_dotenv()
+
+# OpenMP and MKL read their thread counts when torch is first imported, so pin them before any torch import
+os.environ.setdefault('OMP_NUM_THREADS', os.getenv('TORCH_THREADS', str(os.cpu_count() or 1)))
+os.environ.setdefault('MKL_NUM_THREADS', os.environ['OMP_NUM_THREADS'])
+
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
 from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from dotenv import load_dotenv
-import uuid
 import torch
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 import json # Import the json module
 
+try:
+    import orjson
+except ImportError: # orjson is optional; Flask's default JSON provider is used without it
+    orjson = None
+
 # Import functions from our modules
 from model import load_densenet_model, predict_image, CONDITIONS
 from utils import preprocess_image
 
-# Load environment variables from .env file
-load_dotenv()
+# model.py and utils.py log through the logging module; LOG_LEVEL=DEBUG shows their detailed output
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(levelname)s %(name)s: %(message)s')
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
+
+if orjson is not None:
+    class OrjsonProvider(JSONProvider):
+        """Flask JSON provider backed by orjson (C/Rust serializer, much faster than the stdlib json module)."""
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, option=self.option).decode('utf-8')
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+        def response(self, *args, **kwargs):
+            # Hand orjson's bytes straight to the response instead of round-tripping through str
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype='application/json')
+
+    app.json = OrjsonProvider(app)
+    parse_json = orjson.loads
+else:
+    parse_json = json.loads
 
 # Set max file size to 50MB
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
@@ -59,23 +98,28 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Load the model once when the app starts
-# NOTE: On Render's free tier, loading the model on startup can cause timeout issues
-# So we'll load it lazily on first use instead
+# The model is loaded lazily on first use when app.py is run directly.
+# Under Gunicorn, wsgi.py reads the weights in the master process and each worker
+# finishes loading the model before serving (see post_worker_init in gunicorn.conf.py).
 chexnet_model = None
+# gthread workers serve several requests at once; only one of them may build the model
+_model_load_lock = threading.Lock()
 
 def ensure_model_loaded():
     """Lazy load the model on first use."""
     global chexnet_model
     if chexnet_model is None:
-        try:
-            print("Loading CheXNet model on first request...")
-            chexnet_model = load_densenet_model(app.config['MODEL_PATH'])
-            print("DEBUG: CheXNet model loaded successfully.")
-        except Exception as e:
-            print(f"ERROR: Failed to load AI model: {e}")
-            chexnet_model = None
-            raise
+        with _model_load_lock:
+            # Another thread may have finished loading while this one waited for the lock
+            if chexnet_model is None:
+                try:
+                    print("Loading CheXNet model on first request...")
+                    chexnet_model = load_densenet_model(app.config['MODEL_PATH'])
+                    print("DEBUG: CheXNet model loaded successfully.")
+                except Exception as e:
+                    print(f"ERROR: Failed to load AI model: {e}")
+                    chexnet_model = None
+                    raise
     return chexnet_model
 
 # Initialize Gemini AI
@@ -97,9 +141,100 @@ if app.config['GEMINI_API_KEY']:
 else:
     print("WARNING: GEMINI_API_KEY not found in environment variables. Report generation will not work.")
 
-# IMPORTANT: Do NOT load model on startup - only load on first request
-# This prevents timeout issues on Render's free tier
-print("Backend initialized. Model will be loaded on first prediction request.")
+# Report prompt, filled once per request. The optional sections below carry their own leading newlines.
+REPORT_PROMPT_TEMPLATE = (
+    "Generate a comprehensive medical report for an X-ray analysis.\n"
+    "The output MUST be a JSON object with the following keys: \"summary\", \"findings\", \"impression\", \"recommendations\".\n"
+    "Each value should be a string.\n"
+    "\n"
+    "Patient Information:\n"
+    "- ID: {patient_id}{age_line}{gender_line}{history_line}\n"
+    "\n"
+    "Primary AI Analysis Result (MAIN FOCUS of this Report):\n" # Even stronger emphasis
+    "- Detected Condition: {condition_label}\n"
+    "- Description: {condition_description}\n"
+    "- Confidence Level: {confidence:.1f}%\n"
+    "- Severity Level: {condition_severity}"
+    "{secondary_conditions}"
+    "{no_finding_instructions}\n"
+    "\n"
+    "Generate a comprehensive medical report for an X-ray analysis. The report MUST EXCLUSIVELY focus on the 'Detected Condition' provided as the MAIN FOCUS for the 'Key Findings' and 'Impression' sections.\n" # Stronger instruction
+    "The output MUST be a JSON object with the following keys: \"summary\", \"findings\", \"impression\", \"recommendations\".\n"
+    "Each value should be a string.\n"
+    "For \"Key Findings\", STRICTLY describe only the specific characteristics and anatomical location related to {condition_label}. Do NOT include findings for other conditions here.\n" # Very explicit
+    "For \"Impression\", provide a concise summary, focusing SOLELY on the primary detected condition. Include differential diagnoses if relevant to the primary condition.\n" # Very explicit
+    "For \"Recommendations\", include appropriate follow-up timing and any additional imaging or clinical correlation needed, related to the primary condition."
+)
+
+# Clarify the role of secondary findings and deemphasize them
+SECONDARY_CONDITIONS_PREFIX = "\n\nSecondary AI-Detected Conditions (for comprehensive overview, but NOT the primary focus of 'Key Findings' or 'Impression'):\n"
+
+# Specific instruction for no significant finding
+NO_FINDING_INSTRUCTIONS = (
+    "\n\nIMPORTANT: The AI model detected no significant findings with high confidence. The report should reflect this uncertainty and recommend further human review.\n"
+    "For 'Key Findings', state that no clear abnormalities were identified by AI, but suggest manual review.\n"
+    "For 'Impression', suggest 'No acute cardiopulmonary abnormality detected by AI, but clinical correlation and radiologist review are recommended.'\n"
+    "For 'Recommendations', strongly advise a radiologist's comprehensive review and correlation with clinical history."
+)
+
+# Safety settings for report generation (built once, reused for every Gemini call)
+SAFETY_SETTINGS = [
+    {
+        "category": HarmCategory.HARM_CATEGORY_HARASSMENT,
+        "threshold": HarmBlockThreshold.BLOCK_NONE,
+    },
+    {
+        "category": HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+        "threshold": HarmBlockThreshold.BLOCK_NONE,
+    },
+    {
+        "category": HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+        "threshold": HarmBlockThreshold.BLOCK_NONE,
+    },
+    {
+        "category": HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        "threshold": HarmBlockThreshold.BLOCK_NONE,
+    },
+]
+
+# Ask Gemini for structured output so the response is always a bare JSON report object
+REPORT_GENERATION_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema={
+        "type": "object",
+        "properties": {
+            "summary": {"type": "string"},
+            "findings": {"type": "string"},
+            "impression": {"type": "string"},
+            "recommendations": {"type": "string"},
+        },
+        "required": ["summary", "findings", "impression", "recommendations"],
+    },
+)
+
+# Parsed Gemini reports cached by SHA-256 of the prompt, so frontend retries and report
+# re-downloads for the same analysis skip the Gemini round-trip. The cache is per worker process.
+REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', '512'))
+_report_cache = OrderedDict()
+_report_cache_lock = threading.Lock()
+
+def get_cached_report(prompt_hash):
+    """Returns the cached report for the prompt hash (marking it most recently used), or None."""
+    with _report_cache_lock:
+        report = _report_cache.get(prompt_hash)
+        if report is not None:
+            _report_cache.move_to_end(prompt_hash)
+        return report
+
+def cache_report(prompt_hash, report):
+    """Stores a successfully parsed report, evicting the least recently used entries beyond REPORT_CACHE_SIZE."""
+    with _report_cache_lock:
+        _report_cache[prompt_hash] = report
+        _report_cache.move_to_end(prompt_hash)
+        while len(_report_cache) > REPORT_CACHE_SIZE:
+            _report_cache.popitem(last=False)
+
+print("Backend initialized.")
 
 
 @app.route('/')
@@ -211,7 +346,6 @@ def predict():
             print(f"ERROR: Invalid file type: {file.filename}")
             return jsonify({"error": "Invalid file type. Allowed types: png, jpg, jpeg, gif"}), 400
         
-        filepath = None
         try:
             # Load or ensure model is loaded
             print("DEBUG: Checking model state...")
@@ -227,35 +361,28 @@ def predict():
                     traceback.print_exc()
                     return jsonify({"error": f"Model load failed: {str(e)[:100]}"}), 503
             
-            # Save file
-            print("DEBUG: Saving file...")
-            filename = str(uuid.uuid4()) + os.path.splitext(file.filename)[1]
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            print(f"DEBUG: File saved at {filepath}")
-            
-            # Preprocess
+            # Preprocess straight from the upload stream (no temp file on disk)
             print("DEBUG: Preprocessing image...")
-            preprocessed_image = preprocess_image(filepath)
+            preprocessed_image = preprocess_image(file.stream)
             print(f"DEBUG: Image preprocessed successfully")
             
             # Predict
             print("DEBUG: Running inference...")
-            disease_probabilities, no_significant_finding = predict_image(model, preprocessed_image)
+            disease_probabilities, no_significant_finding, top_condition, top_probability = predict_image(model, preprocessed_image)
             print(f"DEBUG: Inference complete")
             
-            # Clear memory after inference
+            # No per-request gc.collect()/empty_cache(): tensors are freed by refcounting, and handing
+            # the CUDA caching allocator's blocks back to the driver would make every request re-allocate
             del preprocessed_image
-            torch.cuda.empty_cache()
-            gc.collect()
-            print("DEBUG: Memory freed after inference")
             
             # Return results
             return jsonify({
                 "status": "success",
                 "predictions": disease_probabilities,
                 "conditions_order": CONDITIONS,
-                "no_significant_finding": no_significant_finding
+                "no_significant_finding": no_significant_finding,
+                "top_condition": top_condition,
+                "top_probability": top_probability
             }), 200
             
         except Exception as e:
@@ -263,20 +390,6 @@ def predict():
             import traceback
             traceback.print_exc()
             return jsonify({"error": f"Prediction error: {str(e)[:100]}"}), 500
-        
-        finally:
-            # Always clean up temp file
-            if filepath and os.path.exists(filepath):
-                try:
-                    os.remove(filepath)
-                    print(f"DEBUG: Temp file removed")
-                except Exception as e:
-                    print(f"WARNING: Failed to remove temp file: {e}")
-            
-            # Force memory cleanup on exit
-            gc.collect()
-            torch.cuda.empty_cache()
-            print("DEBUG: Final cleanup complete")
                     
     except Exception as e:
         print(f"ERROR: Critical exception in /predict: {type(e).__name__}: {e}")
@@ -305,108 +418,53 @@ def generate_report_endpoint():
 
     try: 
         # Construct the prompt using the received data
-        condition_label = conditions_metadata[analysis_results['condition']]['label']
-        condition_description = conditions_metadata[analysis_results['condition']]['description']
-        condition_severity = conditions_metadata[analysis_results['condition']]['severity'].upper()
-
-        prompt_lines = [
-            "Generate a comprehensive medical report for an X-ray analysis.",
-            "The output MUST be a JSON object with the following keys: \"summary\", \"findings\", \"impression\", \"recommendations\".",
-            "Each value should be a string.",
-            "",
-            "Patient Information:",
-            f"- ID: {patient_info['id']}",
-        ]
-
-        if patient_info.get('age'):
-            prompt_lines.append(f"- Age: {patient_info['age']}")
-        if patient_info.get('gender'):
-            prompt_lines.append(f"- Gender: {patient_info['gender']}")
-        if patient_info.get('clinicalHistory'):
-            prompt_lines.append(f"- Clinical History: {patient_info['clinicalHistory']}")
-
-        prompt_lines.extend([
-            "",
-            "Primary AI Analysis Result (MAIN FOCUS of this Report):", # Even stronger emphasis
-            f"- Detected Condition: {condition_label}",
-            f"- Description: {condition_description}",
-            f"- Confidence Level: {(analysis_results['confidence'] * 100):.1f}%",
-            f"- Severity Level: {condition_severity}",
-        ])
-
-        if analysis_results.get('additionalContext'):
-            prompt_lines.append(f"\nSecondary AI-Detected Conditions (for comprehensive overview, but NOT the primary focus of 'Key Findings' or 'Impression'):") # Clarify role and deemphasize
-            prompt_lines.append(analysis_results['additionalContext'])
-        
-        # Add specific instruction for no significant finding
-        if analysis_results.get('noSignificantFinding'):
-            prompt_lines.append("\nIMPORTANT: The AI model detected no significant findings with high confidence. The report should reflect this uncertainty and recommend further human review.")
-            prompt_lines.append("For 'Key Findings', state that no clear abnormalities were identified by AI, but suggest manual review.")
-            prompt_lines.append("For 'Impression', suggest 'No acute cardiopulmonary abnormality detected by AI, but clinical correlation and radiologist review are recommended.'")
-            prompt_lines.append("For 'Recommendations', strongly advise a radiologist's comprehensive review and correlation with clinical history.")
-
-
-        prompt_lines.extend([
-            "",
-            "Generate a comprehensive medical report for an X-ray analysis. The report MUST EXCLUSIVELY focus on the 'Detected Condition' provided as the MAIN FOCUS for the 'Key Findings' and 'Impression' sections.", # Stronger instruction
-            "The output MUST be a JSON object with the following keys: \"summary\", \"findings\", \"impression\", \"recommendations\".",
-            "Each value should be a string.",
-            f"For \"Key Findings\", STRICTLY describe only the specific characteristics and anatomical location related to {condition_label}. Do NOT include findings for other conditions here.", # Very explicit
-            "For \"Impression\", provide a concise summary, focusing SOLELY on the primary detected condition. Include differential diagnoses if relevant to the primary condition.", # Very explicit
-            "For \"Recommendations\", include appropriate follow-up timing and any additional imaging or clinical correlation needed, related to the primary condition.",
-        ])
-
-        prompt = "\n".join(prompt_lines)
-        print(f"DEBUG: Gemini AI prompt:\n{prompt}") # Log the full prompt
-
-        # Configure safety settings for content generation
-        safety_settings = [
-            {
-                "category": HarmCategory.HARM_CATEGORY_HARASSMENT,
-                "threshold": HarmBlockThreshold.BLOCK_NONE,
-            },
-            {
-                "category": HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                "threshold": HarmBlockThreshold.BLOCK_NONE,
-            },
-            {
-                "category": HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                "threshold": HarmBlockThreshold.BLOCK_NONE,
-            },
-            {
-                "category": HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                "threshold": HarmBlockThreshold.BLOCK_NONE,
-            },
-        ]
-
-        response = gemini_model.generate_content(prompt, safety_settings=safety_settings)
+        condition_metadata = conditions_metadata[analysis_results['condition']]
+        condition_label = condition_metadata['label']
+        condition_description = condition_metadata['description']
+        condition_severity = condition_metadata['severity'].upper()
+
+        age_line = f"\n- Age: {age}" if (age := patient_info.get('age')) else ""
+        gender_line = f"\n- Gender: {gender}" if (gender := patient_info.get('gender')) else ""
+        history_line = f"\n- Clinical History: {history}" if (history := patient_info.get('clinicalHistory')) else ""
+        additional_context = analysis_results.get('additionalContext')
+
+        prompt = REPORT_PROMPT_TEMPLATE.format(
+            patient_id=patient_info['id'],
+            age_line=age_line,
+            gender_line=gender_line,
+            history_line=history_line,
+            condition_label=condition_label,
+            condition_description=condition_description,
+            confidence=analysis_results['confidence'] * 100,
+            condition_severity=condition_severity,
+            secondary_conditions=SECONDARY_CONDITIONS_PREFIX + additional_context if additional_context else "",
+            no_finding_instructions=NO_FINDING_INSTRUCTIONS if analysis_results.get('noSignificantFinding') else "",
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Gemini AI prompt:\n%s", prompt)
+
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        cached_report = get_cached_report(prompt_hash)
+        if cached_report is not None:
+            logger.debug("Returning cached report for prompt %s", prompt_hash[:12])
+            return jsonify({"report": cached_report}), 200
+
+        response = gemini_model.generate_content(
+            prompt,
+            safety_settings=SAFETY_SETTINGS,
+            generation_config=REPORT_GENERATION_CONFIG,
+        )
         response_text = response.text
         print(f"DEBUG: Raw Gemini AI response text:\n{response_text}") # Log raw response
 
-        # --- START FIX ---
-        # Extract the JSON string from the markdown block
-        json_start = response_text.find("```json")
-        json_end = response_text.rfind("```")
-
-        if json_start != -1 and json_end != -1 and json_start < json_end:
-            raw_json_string = response_text[json_start + len("```json"):json_end].strip()
-            print(f"DEBUG: Extracted raw JSON string:\n{raw_json_string}")
-            try:
-                parsed_report_dict = json.loads(raw_json_string)
-                return jsonify({"report": parsed_report_dict}), 200
-            except json.JSONDecodeError as e:
-                print(f"ERROR: Failed to parse extracted JSON string: {e}")
-                return jsonify({"error": "Failed to parse AI generated report. Invalid JSON format after extraction."}), 500
-        else:
-            # If no markdown block is found, try to parse the whole response_text as JSON
-            try:
-                parsed_report_dict = json.loads(response_text)
-                return jsonify({"report": parsed_report_dict}), 200
-            except json.JSONDecodeError as e:
-                print(f"ERROR: Gemini AI response was not a valid JSON string or markdown block: {e}")
-                print(f"Raw Gemini AI response: {response_text}")
-                return jsonify({"error": "Failed to parse AI generated report. Unexpected response format."}), 500
-        # --- END FIX ---
+        # JSON mode guarantees the response body is the raw report object (no markdown fences)
+        try:
+            parsed_report_dict = parse_json(response_text)
+        except json.JSONDecodeError as e:
+            print(f"ERROR: Gemini AI response was not valid JSON: {e}")
+            return jsonify({"error": "Failed to parse AI generated report. Invalid JSON format."}), 500
+        cache_report(prompt_hash, parsed_report_dict)
+        return jsonify({"report": parsed_report_dict}), 200
 
     except Exception as e:
         print(f"Error generating report with Gemini AI: {e}")
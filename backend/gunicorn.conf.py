@@ -0,0 +1,55 @@
+import os
+from dotenv import load_dotenv
+
+# Read .env before the settings below, so values there (WEB_CONCURRENCY, GUNICORN_THREADS,
+# CHEXNET_BATCHING, ...) take effect. It never overrides variables already set in the environment.
+load_dotenv()
+
+def _available_cpus() -> int:
+    """CPUs this process may run on (respects container CPU sets, unlike os.cpu_count())."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# Check for a GPU through NVML when model.py is imported in the master. The default check
+# initialises the CUDA driver, which forked workers then can't use.
+os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# A single worker by default: every worker holds its own copy of the model, which doesn't fit
+# small instances (e.g. Render's 512 MB free plan). The worker runs a few threads so requests
+# blocked on the Gemini API in /generate_report don't hold it hostage, and PyTorch's intra-op
+# pool uses all cores. On larger hosts, set WEB_CONCURRENCY to run more workers in parallel.
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+if threads > 1:
+    # Threads in one worker can share forward passes (see InferenceBatcher in model.py).
+    # Only a default: CHEXNET_BATCHING=0 in the environment or .env still turns it off.
+    os.environ.setdefault('CHEXNET_BATCHING', '1')
+
+# Load the app (and read the model weights, see wsgi.py) in the master before forking
+preload_app = True
+timeout = 120
+
+def post_fork(server, worker):
+    """Split the cores between workers so N workers x T torch threads don't oversubscribe the CPU."""
+    import torch
+    # server.cfg reflects command-line overrides such as -w, unlike this module's `workers`
+    torch.set_num_threads(int(os.getenv('TORCH_THREADS', max(1, _available_cpus() // server.cfg.workers))))
+
+def post_worker_init(worker):
+    """
+    Finishes loading the model in each worker before it accepts requests. Runtime sessions,
+    thread pools and CUDA contexts must be created after fork, so this can't happen in the master.
+    The load counts against `timeout`, so raise it if a one-off build (e.g. the first TensorRT
+    engine, cached on disk afterwards) takes longer.
+    """
+    if os.getenv('PRELOAD_MODEL', '1') == '1':
+        from app import ensure_model_loaded
+        try:
+            ensure_model_loaded()
+        except Exception:
+            # Already logged; the worker keeps serving and retries on the first /predict request
+            pass
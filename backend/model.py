@@ -1,9 +1,56 @@
 import torch
 import torch.nn as nn
+import torchvision
 from torchvision import models
 import os
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
 import numpy as np
 
+try:
+    import fcntl
+except ImportError: # Not available on Windows; artifact builds are then not serialised between processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+try:
+    import onnxruntime as ort
+except ImportError: # ONNX Runtime is optional; only needed when CHEXNET_BACKEND=onnx
+    ort = None
+
+try:
+    import intel_extension_for_pytorch as ipex
+except ImportError: # IPEX is optional; without it BF16 runs through plain PyTorch/oneDNN
+    ipex = None
+
+try:
+    import tensorrt as trt
+except ImportError: # TensorRT is optional; only needed when CHEXNET_BACKEND=tensorrt
+    trt = None
+
+try:
+    import openvino as ov
+except ImportError: # OpenVINO is optional; only needed when CHEXNET_BACKEND=openvino
+    ov = None
+
+# DenseNet's dense blocks are a long sequential chain of concats, so a single intra-op pool
+# spanning all cores (or TORCH_THREADS) is better than splitting the threads with an inter-op pool
+TORCH_THREADS = int(os.getenv('TORCH_THREADS', os.cpu_count() or 1))
+torch.set_num_threads(TORCH_THREADS)
+torch.set_num_interop_threads(1)
+torch.backends.mkldnn.enabled = True
+
+# Allow TF32 on Ampere+ GPUs for the classifier matmul and the convs (cuDNN); no effect on CPU
+torch.set_float32_matmul_precision('high')
+torch.backends.cudnn.allow_tf32 = True
+
+# Let the TorchScript fuser collapse Conv-BN-ReLU chains into fused oneDNN kernels
+torch.jit.enable_onednn_fusion(True)
+
 class CheXNet(nn.Module):
     def __init__(self, num_classes=14):
         super(CheXNet, self).__init__()
@@ -42,94 +89,803 @@ NO_FINDING_THRESHOLD = 0.35
 
 _chexnet_model = None
 
+# Checkpoint keys saved from the bare DenseNet that need the wrapper's 'model.' prefix
+_UNPREFIXED_KEYS = ('features.', 'classifier.')
+
+# Shape of a single preprocessed image, used for tracing, exports and warm-up. The image size is fixed,
+# but the batch size is not: with CHEXNET_BATCHING the runtimes see batches of up to MAX_BATCH_SIZE
+# (dynamic batch axis in the ONNX export, TensorRT optimisation profile, dynamic dim 0 under torch.compile).
+INPUT_SHAPE = (1, 3, 224, 224)
+
+# Inference runtime used for the loaded model:
+# - "torchscript" (default): frozen TorchScript graph
+# - "onnx": ONNX Runtime session (requires the onnxruntime package)
+# - "tensorrt": TensorRT INT8 engine built from the ONNX export (requires tensorrt and a CUDA GPU;
+#   falls back to "onnx" otherwise). Calibrates on the images in CHEXNET_CALIBRATION_DIR.
+# - "openvino": OpenVINO CPU runtime on an FP16-compressed IR converted from the ONNX export
+#   (requires the openvino package; INT8 with CHEXNET_INT8=1 additionally requires nncf)
+CHEXNET_BACKEND = os.getenv('CHEXNET_BACKEND', 'torchscript').lower()
+if CHEXNET_BACKEND == 'tensorrt' and (trt is None or not torch.cuda.is_available()):
+    logger.warning("CHEXNET_BACKEND=tensorrt needs the tensorrt package and a CUDA GPU; falling back to onnx.")
+    CHEXNET_BACKEND = 'onnx'
+# The ONNX-based backends run outside PyTorch; the model is only built in PyTorch to export it
+TORCH_RUNTIME = CHEXNET_BACKEND not in ('onnx', 'tensorrt', 'openvino')
+
+# Set CHEXNET_INT8=1 to serve an INT8-quantized model.
+# The TorchScript backend uses post-training static quantization and needs a folder of sample
+# X-rays (CHEXNET_CALIBRATION_DIR); the ONNX backend uses dynamic quantization and needs none.
+CHEXNET_INT8 = os.getenv('CHEXNET_INT8', '0') == '1'
+CALIBRATION_DIR = os.getenv('CHEXNET_CALIBRATION_DIR', '')
+CALIBRATION_MAX_IMAGES = 50
+
+# Run on the GPU when one is available. The INT8 path uses CPU kernels only, and the ONNX-based
+# backends manage their own devices, so PyTorch stays on the CPU for them.
+if torch.cuda.is_available() and TORCH_RUNTIME and not CHEXNET_INT8:
+    DEVICE = torch.device('cuda')
+    # Input shape is fixed at 224x224, so let cuDNN benchmark and pick the fastest conv algorithms once
+    torch.backends.cudnn.benchmark = True
+else:
+    DEVICE = torch.device('cpu')
+
+def _cpu_supports_bf16() -> bool:
+    return torch.backends.mkldnn.is_available() and torch.cpu._is_avx512_bf16_supported()
+
+# x86 CPUs have no native fp16 kernels (it is emulated and slower than fp32), but BF16 is
+# accelerated by AVX512-BF16/AMX, so the TorchScript backend runs in BF16 when the CPU supports it.
+# Set CHEXNET_BF16=0 to force fp32.
+USE_BF16 = (
+    DEVICE.type == 'cpu' and TORCH_RUNTIME and not CHEXNET_INT8
+    and os.getenv('CHEXNET_BF16', '1') == '1' and _cpu_supports_bf16()
+)
+
+# With Intel Extension for PyTorch installed, the CPU model is optimised by IPEX (Conv+BN+ReLU fusion,
+# oneDNN/AMX kernels). In BF16 mode IPEX keeps fp32 inputs and runs the model under BF16 autocast
+# instead of converting the whole model to bfloat16.
+USE_IPEX = ipex is not None and DEVICE.type == 'cpu' and TORCH_RUNTIME and not CHEXNET_INT8
+AUTOCAST_BF16 = USE_IPEX and USE_BF16
+INFERENCE_DTYPE = torch.bfloat16 if USE_BF16 and not USE_IPEX else torch.float32
+
+# Set CHEXNET_COMPILE=1 to serve the model through torch.compile (Inductor, autotuned kernels)
+# instead of a frozen TorchScript graph. The compiled model can't be cached on disk, so every start
+# pays the compile cost (during warm-up, not on the first request). Not combined with INT8.
+CHEXNET_COMPILE = os.getenv('CHEXNET_COMPILE', '0') == '1' and TORCH_RUNTIME and not CHEXNET_INT8
+
+# The PyTorch runtimes run convs in NHWC (channels_last), the layout oneDNN and cuDNN/Tensor Core
+# kernels prefer; the ONNX-based backends pick their own layouts from plain NCHW input
+MEMORY_FORMAT = torch.channels_last if TORCH_RUNTIME else torch.contiguous_format
+
+def _autocast():
+    """BF16 autocast context for the IPEX path (disabled otherwise)."""
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=AUTOCAST_BF16)
+
+def _artifact_path(model_path: str, extension: str) -> str:
+    """
+    Returns the path of a derived model artifact (TorchScript, ONNX, ...) for the given .pth file.
+    The .pth modification time is part of the name so replacing the weights invalidates the cache.
+    """
+    mtime = int(os.path.getmtime(model_path))
+    return f"{os.path.splitext(model_path)[0]}.{mtime}.{extension}"
+
+class OnnxCheXNet:
+    """
+    Callable wrapper around an ONNX Runtime session that mirrors the CheXNet module interface
+    (tensor in, tensor out) so predict_image does not need to know which runtime is in use.
+    The session is created in the process that first runs the model, and again after a fork:
+    neither its thread pool nor the CUDA execution provider's context survive fork().
+    """
+    def __init__(self, onnx_path: str, providers: list):
+        self.onnx_path = onnx_path
+        self.providers = providers
+        self._session = None
+        self._input_name = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+
+    def _create_session(self):
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # Same per-process thread budget as PyTorch (TORCH_THREADS, split between Gunicorn workers in post_fork)
+        session_options.intra_op_num_threads = torch.get_num_threads()
+        session = ort.InferenceSession(self.onnx_path, sess_options=session_options, providers=self.providers)
+        logger.debug("ONNX Runtime session created from %s with providers %s", self.onnx_path, session.get_providers())
+        return session
+
+    def __call__(self, image_tensor: torch.Tensor) -> torch.Tensor:
+        if self._session_pid != os.getpid():
+            with self._session_lock:
+                if self._session_pid != os.getpid():
+                    self._session = self._create_session()
+                    self._input_name = self._session.get_inputs()[0].name
+                    self._session_pid = os.getpid()
+        output = self._session.run(None, {self._input_name: image_tensor.numpy()})[0]
+        return torch.from_numpy(output)
+
+def _calibration_image_paths() -> list:
+    """Returns up to CALIBRATION_MAX_IMAGES sample X-rays from CALIBRATION_DIR for INT8 calibration."""
+    if not CALIBRATION_DIR or not os.path.isdir(CALIBRATION_DIR):
+        return []
+    return sorted(
+        os.path.join(CALIBRATION_DIR, name) for name in os.listdir(CALIBRATION_DIR)
+        if name.lower().endswith(('.png', '.jpg', '.jpeg'))
+    )[:CALIBRATION_MAX_IMAGES]
+
+def _export_onnx(model: nn.Module, model_path: str) -> str:
+    """Exports the eval-mode model to ONNX once (cached next to the .pth file) and returns the file path."""
+    onnx_path = _artifact_path(model_path, 'onnx')
+    with _artifact_lock(onnx_path):
+        if not os.path.exists(onnx_path):
+            logger.debug("Exporting CheXNet to ONNX at %s", onnx_path)
+            # Write to a temporary file first so other processes never open a partial export
+            tmp_path = f"{onnx_path}.{os.getpid()}.tmp.onnx"
+            torch.onnx.export(
+                model,
+                torch.zeros(INPUT_SHAPE),
+                tmp_path,
+                input_names=['input'],
+                output_names=['output'],
+                opset_version=17,
+                dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+            )
+            os.replace(tmp_path, onnx_path)
+    return onnx_path
+
+def _load_onnx_session(model: nn.Module, model_path: str) -> OnnxCheXNet:
+    """
+    Prepares the ONNX export of the model for ONNX Runtime with full graph optimisation
+    (Conv+BN+ReLU fusion, constant folding). The session itself is opened on first use.
+    """
+    if ort is None:
+        raise RuntimeError("CHEXNET_BACKEND=onnx requires the 'onnxruntime' package to be installed.")
+
+    onnx_path = _export_onnx(model, model_path)
+    if CHEXNET_INT8:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        int8_path = _artifact_path(model_path, 'int8.onnx')
+        with _artifact_lock(int8_path):
+            if not os.path.exists(int8_path):
+                logger.debug("Quantizing ONNX model to INT8 at %s", int8_path)
+                tmp_path = f"{int8_path}.{os.getpid()}.tmp.onnx"
+                quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+                os.replace(tmp_path, int8_path)
+        onnx_path = int8_path
+
+    providers = ['CPUExecutionProvider']
+    # The INT8 model uses CPU-only integer kernels; otherwise prefer the GPU when onnxruntime-gpu provides it
+    if not CHEXNET_INT8 and 'CUDAExecutionProvider' in ort.get_available_providers():
+        providers.insert(0, 'CUDAExecutionProvider')
+    return OnnxCheXNet(onnx_path, providers)
+
+class TensorRTCheXNet:
+    """
+    Callable wrapper around a TensorRT engine with the CheXNet module interface (tensor in, tensor out).
+    Input and output buffers are CUDA tensors, so no extra CUDA bindings package is needed.
+    """
+    def __init__(self, engine, runtime):
+        # The runtime has to outlive the engine it deserialized
+        self.runtime = runtime
+        self.engine = engine
+        self.context = engine.create_execution_context()
+        # An execution context must not be used by two threads at once
+        self.lock = threading.Lock()
+
+    def __call__(self, image_tensor: torch.Tensor) -> torch.Tensor:
+        device_input = image_tensor.to('cuda', dtype=torch.float32).contiguous()
+        device_output = torch.empty((device_input.shape[0], len(CONDITIONS)), dtype=torch.float32, device='cuda')
+        with self.lock:
+            # Both report failure by returning False, which would leave device_output uninitialised
+            if not self.context.set_input_shape('input', tuple(device_input.shape)):
+                raise RuntimeError(f"TensorRT engine rejected input shape {tuple(device_input.shape)}")
+            if not self.context.execute_v2([device_input.data_ptr(), device_output.data_ptr()]):
+                raise RuntimeError("TensorRT inference failed.")
+        return device_output.cpu()
+
+def _tensorrt_engine_path(model_path: str) -> str:
+    """
+    Returns the cached engine path. A serialized engine only works with the TensorRT version and
+    GPU model it was built with, and only accepts batches up to the profile's maximum, so all
+    three are part of the name.
+    """
+    device_name = ''.join(c if c.isalnum() else '-' for c in torch.cuda.get_device_name())
+    return _artifact_path(model_path, f"trt{trt.__version__}.{device_name}.b{MAX_BATCH_SIZE}.int8.engine")
+
+def _serialize_tensorrt_engine(model: nn.Module, model_path: str, trt_logger) -> bytes:
+    """Compiles the ONNX export into a serialized INT8 TensorRT engine, calibrating on CALIBRATION_DIR."""
+    from utils import preprocess_image
+
+    calibration_cache_path = _artifact_path(model_path, 'int8.calib')
+    image_paths = _calibration_image_paths()
+    if not image_paths and not os.path.exists(calibration_cache_path):
+        raise RuntimeError("CHEXNET_BACKEND=tensorrt requires sample X-ray images in CHEXNET_CALIBRATION_DIR for INT8 calibration.")
+
+    class EntropyCalibrator(trt.IInt8EntropyCalibrator2):
+        def __init__(self):
+            trt.IInt8EntropyCalibrator2.__init__(self)
+            self.pending = list(image_paths)
+            self.device_input = None
+
+        def get_batch_size(self):
+            return 1
+
+        def get_batch(self, names):
+            if not self.pending:
+                return None
+            self.device_input = preprocess_image(self.pending.pop(0)).to('cuda').contiguous()
+            return [self.device_input.data_ptr()]
+
+        def read_calibration_cache(self):
+            if os.path.exists(calibration_cache_path):
+                with open(calibration_cache_path, 'rb') as f:
+                    return f.read()
+            return None
+
+        def write_calibration_cache(self, cache):
+            tmp_path = f"{calibration_cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(cache)
+            os.replace(tmp_path, calibration_cache_path)
+
+    onnx_path = _export_onnx(model, model_path)
+    logger.debug("Building TensorRT INT8 engine from %s (calibrating on %s images)", onnx_path, len(image_paths))
+    builder = trt.Builder(trt_logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, trt_logger)
+    with open(onnx_path, 'rb') as f:
+        if not parser.parse(f.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError(f"TensorRT could not parse {onnx_path}: {errors}")
+
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.INT8)
+    config.int8_calibrator = EntropyCalibrator()
+    # The ONNX batch axis is dynamic; allow batches up to the micro-batcher's limit
+    profile = builder.create_optimization_profile()
+    profile.set_shape('input', INPUT_SHAPE, INPUT_SHAPE, (MAX_BATCH_SIZE,) + INPUT_SHAPE[1:])
+    config.add_optimization_profile(profile)
+    config.set_calibration_profile(profile)
+
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        raise RuntimeError("TensorRT engine build failed.")
+    return bytes(serialized_engine)
+
+def _build_tensorrt_engine(model: nn.Module, model_path: str) -> TensorRTCheXNet:
+    """
+    Loads the cached INT8 TensorRT engine, or compiles it from the ONNX export with an entropy
+    calibrator over the sample X-rays in CALIBRATION_DIR. The serialized engine and the calibration
+    cache are stored next to the .pth file, so the (slow) build only happens once per GPU host.
+    A cached engine that this TensorRT can't deserialize is rebuilt.
+    """
+    trt_logger = trt.Logger(trt.Logger.WARNING)
+    runtime = trt.Runtime(trt_logger)
+    engine_path = _tensorrt_engine_path(model_path)
+    with _artifact_lock(engine_path):
+        engine = None
+        if os.path.exists(engine_path):
+            logger.debug("Loading cached TensorRT engine from %s", engine_path)
+            with open(engine_path, 'rb') as f:
+                engine = runtime.deserialize_cuda_engine(f.read())
+            if engine is None:
+                logger.warning("Cached TensorRT engine %s could not be deserialized; rebuilding it.", engine_path)
+
+        if engine is None:
+            serialized_engine = _serialize_tensorrt_engine(model, model_path, trt_logger)
+            # Write to a temporary file first so other processes never read a partial engine
+            tmp_path = f"{engine_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(serialized_engine)
+            os.replace(tmp_path, engine_path)
+            logger.debug("TensorRT engine cached at %s", engine_path)
+            engine = runtime.deserialize_cuda_engine(serialized_engine)
+            if engine is None:
+                raise RuntimeError("TensorRT could not deserialize the engine it just built.")
+
+    return TensorRTCheXNet(engine, runtime)
+
+class OpenVinoCheXNet:
+    """
+    Callable wrapper around an OpenVINO compiled model with the CheXNet module interface (tensor in, tensor out).
+    """
+    def __init__(self, compiled_model):
+        self.compiled_model = compiled_model
+        self.output = compiled_model.output(0)
+        # An infer request must not be used by two threads at once
+        self.infer_request = compiled_model.create_infer_request()
+        self.lock = threading.Lock()
+
+    def __call__(self, image_tensor: torch.Tensor) -> torch.Tensor:
+        with self.lock:
+            # share_outputs=False copies the result out of the request's buffer before the lock is released
+            result = self.infer_request.infer([image_tensor.numpy()], share_outputs=False)
+        return torch.from_numpy(result[self.output])
+
+def _load_openvino_model(model: nn.Module, model_path: str) -> OpenVinoCheXNet:
+    """
+    Converts the ONNX export to an OpenVINO IR once (weights compressed to FP16, or NNCF-quantized
+    to INT8 with CHEXNET_INT8=1, calibrated on CALIBRATION_DIR) and compiles it for the CPU with
+    the latency performance hint. The .xml/.bin pair is stored next to the .pth file.
+    """
+    if ov is None:
+        raise RuntimeError("CHEXNET_BACKEND=openvino requires the 'openvino' package to be installed.")
+
+    core = ov.Core()
+    ir_path = _artifact_path(model_path, 'int8.xml' if CHEXNET_INT8 else 'xml')
+    with _artifact_lock(ir_path):
+        if not os.path.exists(ir_path):
+            ov_model = ov.convert_model(_export_onnx(model, model_path))
+            if CHEXNET_INT8:
+                try:
+                    import nncf
+                except ImportError:
+                    raise RuntimeError("CHEXNET_INT8=1 with CHEXNET_BACKEND=openvino requires the 'nncf' package to be installed.")
+                from utils import preprocess_image
+
+                image_paths = _calibration_image_paths()
+                if not image_paths:
+                    raise RuntimeError("CHEXNET_INT8=1 requires sample X-ray images in CHEXNET_CALIBRATION_DIR for calibration.")
+                logger.debug("Quantizing OpenVINO model to INT8 (calibrating on %s images)", len(image_paths))
+                calibration = nncf.Dataset(image_paths, lambda path: preprocess_image(path).numpy())
+                ov_model = nncf.quantize(ov_model, calibration, subset_size=len(image_paths))
+            ov.save_model(ov_model, ir_path, compress_to_fp16=not CHEXNET_INT8)
+            logger.debug("OpenVINO IR cached at %s", ir_path)
+
+    compiled_model = core.compile_model(core.read_model(ir_path), 'CPU', {'PERFORMANCE_HINT': 'LATENCY'})
+    logger.debug("OpenVINO model compiled from %s", ir_path)
+    return OpenVinoCheXNet(compiled_model)
+
+def _quantize_int8(model: nn.Module) -> nn.Module:
+    """
+    Applies FX-graph post-training static INT8 quantization (x86 backend, VNNI kernels),
+    calibrating the activation observers on the images found in CALIBRATION_DIR.
+    The final Sigmoid is left in float so the probabilities keep full resolution instead of
+    being snapped to the 256 levels of a quantized output.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    from utils import preprocess_image
+
+    image_paths = _calibration_image_paths()
+    if not image_paths:
+        raise RuntimeError("CHEXNET_INT8=1 requires sample X-ray images in CHEXNET_CALIBRATION_DIR for calibration.")
+
+    logger.debug("Calibrating INT8 quantization on %s images", len(image_paths))
+    qconfig_mapping = get_default_qconfig_mapping('x86').set_module_name('model.classifier.1', None)
+    prepared = prepare_fx(model, qconfig_mapping, example_inputs=(torch.zeros(INPUT_SHAPE),))
+    with torch.no_grad():
+        for image_path in image_paths:
+            prepared(preprocess_image(image_path))
+    return convert_fx(prepared)
+
+def _warm_up(model) -> None:
+    """
+    Runs two dummy forwards so one-off costs (oneDNN primitive selection, cuDNN algorithm search,
+    TorchScript profiling/specialisation, page-faulting the weights) are paid at load time
+    rather than by the first /predict request.
+    """
+    example = torch.zeros(INPUT_SHAPE, dtype=INFERENCE_DTYPE, device=DEVICE).contiguous(memory_format=MEMORY_FORMAT)
+    with torch.inference_mode(), _autocast():
+        model(example)
+        model(example)
+
+def _torchscript_cache_path(model_path: str) -> str:
+    """Returns the TorchScript snapshot path for the current precision/device configuration."""
+    if CHEXNET_INT8:
+        extension = 'int8.ts'
+    elif USE_IPEX:
+        extension = 'ipex.bf16.ts' if USE_BF16 else 'ipex.ts'
+    elif USE_BF16:
+        extension = 'bf16.ts'
+    elif DEVICE.type == 'cuda':
+        extension = 'cuda.ts'
+    else:
+        extension = 'ts'
+    # TorchScript serialization isn't guaranteed to load across torch versions, so an upgrade starts a new snapshot
+    return _artifact_path(model_path, f"torch{torch.__version__}.{extension}")
+
+def _remove_quietly(path: str) -> None:
+    """Removes a leftover temporary file, ignoring errors (it may never have been created)."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+@contextmanager
+def _artifact_lock(artifact_path: str):
+    """Serialises building an artifact across worker processes (no-op where fcntl is unavailable)."""
+    if fcntl is None:
+        yield
+        return
+    try:
+        lock_file = open(artifact_path + '.lock', 'w')
+    except OSError as e:
+        # Read-only model directory: the artifact can't be cached there either, so build it unlocked
+        logger.debug("Could not create lock file for %s, building without it: %s", artifact_path, e)
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _prepare_torchscript(scripted):
+    """Optimises a frozen graph for inference and warms it up."""
+    # Applied after caching: the optimised graph holds prepacked oneDNN weights that can't be serialized.
+    # IPEX graphs already carry IPEX's own fused kernels.
+    if not CHEXNET_INT8 and not USE_IPEX and DEVICE.type == 'cpu':
+        scripted = torch.jit.optimize_for_inference(scripted)
+    _warm_up(scripted)
+    return scripted
+
+def _load_cached_torchscript(cache_path: str):
+    """
+    Loads a frozen TorchScript snapshot written by an earlier start (or by another worker). This skips
+    building DenseNet-121 in Python, reading and renaming the state_dict, and tracing.
+    Returns None if the snapshot can't be loaded, so the caller rebuilds (and overwrites) it.
+    """
+    logger.debug("Loading cached TorchScript model from %s", cache_path)
+    try:
+        return torch.jit.load(cache_path, map_location=DEVICE)
+    except Exception as e:
+        logger.warning("Could not load TorchScript snapshot %s, rebuilding it: %s: %s", cache_path, type(e).__name__, e)
+        return None
+
+def _freeze_to_torchscript(model: nn.Module, model_path: str) -> nn.Module:
+    """
+    Traces and freezes the eval-mode model into a TorchScript graph (BatchNorm folded into
+    the convolutions, no Python dispatch per layer) and caches it next to the .pth file.
+    The frozen graph is then optimised for inference (oneDNN layouts and fused kernels).
+    Falls back to the eager model if tracing fails.
+    """
+    cache_path = _torchscript_cache_path(model_path)
+    with _artifact_lock(cache_path):
+        # Another worker may have written the snapshot while this one waited for the lock
+        if os.path.exists(cache_path):
+            scripted = _load_cached_torchscript(cache_path)
+            if scripted is not None:
+                return _prepare_torchscript(scripted)
+
+        if CHEXNET_INT8:
+            model = _quantize_int8(model)
+
+        example = torch.zeros(INPUT_SHAPE, dtype=INFERENCE_DTYPE, device=DEVICE).contiguous(memory_format=MEMORY_FORMAT)
+        try:
+            logger.debug("Tracing and freezing CheXNet with TorchScript")
+            with torch.no_grad(), _autocast():
+                scripted = torch.jit.freeze(torch.jit.trace(model, example))
+            try:
+                # Write to a temporary file first so other processes never see a partial snapshot
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                torch.jit.save(scripted, tmp_path)
+                os.replace(tmp_path, cache_path)
+                logger.debug("TorchScript model cached at %s", cache_path)
+            except (OSError, RuntimeError) as e:
+                # torch.jit.save reports unwritable paths as RuntimeError; the frozen graph is still usable
+                logger.warning("Could not cache TorchScript model: %s", e)
+                _remove_quietly(tmp_path)
+            return _prepare_torchscript(scripted)
+        except Exception as e:
+            logger.warning("TorchScript conversion failed, using eager model: %s: %s", type(e).__name__, e)
+            _warm_up(model)
+            return model
+
+def _load_eager_model(model_path: str) -> CheXNet:
+    """
+    Returns the eval-mode CheXNet (CPU, fp32) with the .pth weights loaded.
+    The fully built model is pickled next to the .pth file after the first strict load, so later
+    starts unpickle it in one step instead of constructing DenseNet-121 layer by layer in Python,
+    renaming the state_dict keys and copying them in with load_state_dict.
+    """
+    # The pickle refers to torch/torchvision classes by module path, so it is tied to the installed versions
+    full_path = _artifact_path(model_path, f"torch{torch.__version__}.torchvision{torchvision.__version__}.full.pt")
+    if os.path.exists(full_path):
+        logger.debug("Loading pickled CheXNet model from %s", full_path)
+        try:
+            # Written by this function, not user-supplied, so a full (non weights_only) unpickle is fine
+            return torch.load(full_path, map_location=torch.device('cpu'), mmap=True, weights_only=False)
+        except Exception as e:
+            logger.warning("Could not load pickled model %s, rebuilding it from the .pth: %s: %s", full_path, type(e).__name__, e)
+
+    model = CheXNet()
+    strict_load = False
+    
+    # Load the raw state_dict from the .pth file
+    logger.debug("Loading state_dict from %s", model_path)
+    # mmap maps the file instead of reading every tensor into RAM up front; weights_only refuses arbitrary pickles
+    state_dict = torch.load(model_path, map_location=torch.device('cpu'), mmap=True, weights_only=True)
+    
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    if debug_enabled:
+        logger.debug("Keys in loaded state_dict: %s", list(state_dict.keys()))
+        logger.debug("Keys in current model's state_dict: %s", list(model.state_dict().keys()))
+        logger.debug("Renaming %d state_dict keys to the 'model.' prefix",
+                     sum(k.startswith(_UNPREFIXED_KEYS) for k in state_dict))
+    # Add the missing 'model.' prefix in one pass. The values are mmap-backed views, so the
+    # new dict only holds references and the old one is dropped straight away.
+    state_dict = {
+        ('model.' + k if k.startswith(_UNPREFIXED_KEYS) else k): v
+        for k, v in state_dict.items()
+    }
+    
+    logger.debug("Attempting to load %s keys into model", len(state_dict))
+    # Attempt to load the (potentially modified) state_dict
+    try:
+        model.load_state_dict(state_dict, strict=True)
+        logger.debug("State dictionary loaded strictly (all keys matched after renaming).")
+        strict_load = True
+    except RuntimeError as e:
+        logger.warning("Strict state_dict load failed even after renaming: %s", e)
+        logger.info("Attempting non-strict load to identify remaining mismatches.")
+        missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+        if missing_keys:
+            logger.warning("Missing keys in state_dict: %s", missing_keys)
+        if unexpected_keys:
+            logger.warning("Unexpected keys in state_dict: %s", unexpected_keys)
+        logger.debug("State dictionary loaded non-strictly.")
+    del state_dict
+
+    model.eval() # Set model to evaluation mode (once; predict_image relies on it)
+
+    # Only a model whose weights all matched is worth skipping the state_dict load for next time
+    if strict_load:
+        try:
+            tmp_path = f"{full_path}.{os.getpid()}.tmp"
+            torch.save(model, tmp_path)
+            os.replace(tmp_path, full_path)
+            logger.debug("Pickled CheXNet model cached at %s", full_path)
+        except (OSError, RuntimeError) as e:
+            # torch.save reports unwritable paths as RuntimeError; the model works without the cache
+            logger.warning("Could not cache pickled model: %s", e)
+            _remove_quietly(tmp_path)
+    return model
+
+def _compile_model(model: nn.Module) -> nn.Module:
+    """
+    Compiles the eval-mode model with torch.compile and warms it up, which is when Dynamo actually
+    traces and Inductor generates the kernels. With batching enabled, a second graph with a dynamic
+    batch dimension is compiled too, so new batch sizes never trigger a recompile during a request.
+    Falls back to the eager model if compilation fails.
+    """
+    logger.debug("Compiling CheXNet with torch.compile (max-autotune-no-cudagraphs)")
+    # No CUDA graphs: a replay overwrites the previous outputs, which the batcher's callers and
+    # concurrent request threads may still be reading
+    compiled = torch.compile(model, mode='max-autotune-no-cudagraphs', fullgraph=True)
+    try:
+        _warm_up(compiled)
+        if CHEXNET_BATCHING and MAX_BATCH_SIZE > 1:
+            # Dynamo always specialises a batch of 1 (compiled above), so the dynamic graph starts at 2
+            example = torch.zeros((2,) + INPUT_SHAPE[1:], dtype=INFERENCE_DTYPE, device=DEVICE).contiguous(memory_format=MEMORY_FORMAT)
+            if MAX_BATCH_SIZE > 2:
+                torch._dynamo.mark_dynamic(example, 0, min=2, max=MAX_BATCH_SIZE)
+            with torch.inference_mode(), _autocast():
+                compiled(example)
+        return compiled
+    except Exception as e:
+        logger.warning("torch.compile failed, using eager model: %s: %s", type(e).__name__, e)
+        _warm_up(model)
+        return model
+
+def _check_model_path(model_path: str) -> None:
+    if not model_path or not os.path.exists(model_path):
+        logger.error("PyTorch model file not found at: %s. Please ensure the model is correctly placed and MODEL_PATH is set in .env.", model_path)
+        raise FileNotFoundError(f"AI model file not found at: {model_path}")
+
+def _read_model(model_path: str):
+    """
+    Reads the model from disk without running it: the cached TorchScript snapshot when one
+    applies, otherwise the eager fp32 CPU CheXNet.
+    """
+    cache_path = _torchscript_cache_path(model_path)
+    if TORCH_RUNTIME and not CHEXNET_COMPILE and os.path.exists(cache_path):
+        scripted = _load_cached_torchscript(cache_path)
+        if scripted is not None:
+            return scripted
+    return _load_eager_model(model_path)
+
+# Weights read by preload_model in a pre-fork master, handed to load_densenet_model in each worker
+_preloaded_model = None
+
+def preload_model(model_path: str) -> None:
+    """
+    Reads the model weights in the master process of a pre-fork server (see wsgi.py), so the forked
+    workers start from shared copy-on-write memory; load_densenet_model finishes the load in each worker.
+    Nothing here runs the model or creates a runtime session, because OpenMP / ONNX Runtime / OpenVINO
+    thread pools do not survive fork().
+    """
+    global _preloaded_model
+    if _chexnet_model is not None or _preloaded_model is not None:
+        return
+    if DEVICE.type == 'cuda':
+        # CUDA can't be re-initialised in a forked child, so GPU hosts load entirely in the workers
+        logger.info("Running on CUDA; CheXNet will be loaded by each worker after fork.")
+        return
+    _check_model_path(model_path)
+    logger.info("Preloading CheXNet weights from: %s", model_path)
+    # With a single thread, the tensor copies in load_state_dict run inline and never start the OpenMP pool
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        _preloaded_model = _read_model(model_path)
+    finally:
+        torch.set_num_threads(num_threads)
+
 def load_densenet_model(model_path: str):
     """
-    Loads the PyTorch CheXNet model from the .pth file.
+    Loads the PyTorch CheXNet model from the .pth file (or takes over the weights read by
+    preload_model), then places it on the device, builds the configured runtime and warms it up.
+    Under a pre-fork server this must run in each worker, after fork.
     """
-    global _chexnet_model
+    global _chexnet_model, _preloaded_model
     if _chexnet_model is None:
-        if not model_path or not os.path.exists(model_path):
-            print(f"ERROR: PyTorch model file not found at: {model_path}. Please ensure the model is correctly placed and MODEL_PATH is set in .env.")
-            raise FileNotFoundError(f"AI model file not found at: {model_path}")
+        if _preloaded_model is None:
+            _check_model_path(model_path)
             
-        print(f"Loading PyTorch CheXNet model from: {model_path}")
+        logger.info("Loading PyTorch CheXNet model from: %s", model_path)
         try:
-            _chexnet_model = CheXNet()
-            
-            # Load the raw state_dict from the .pth file
-            print(f"DEBUG: Loading state_dict from {model_path}")
-            state_dict = torch.load(model_path, map_location=torch.device('cpu'))
-            
-            print(f"DEBUG: Keys in loaded state_dict: {list(state_dict.keys())}")
-            print(f"DEBUG: Keys in current model's state_dict: {list(_chexnet_model.state_dict().keys())}")
-
-            # Create a new state_dict to handle potential key mismatches
-            new_state_dict = {}
-            for k, v in state_dict.items():
-                if k.startswith('features.'):
-                    # Prepend 'model.' to feature keys
-                    new_key = 'model.' + k
-                    new_state_dict[new_key] = v
-                    print(f"DEBUG: Renamed state_dict key: '{k}' to '{new_key}'")
-                elif k.startswith('classifier.'):
-                    # For classifier keys, prepend only 'model.'
-                    new_key = 'model.' + k
-                    new_state_dict[new_key] = v
-                    print(f"DEBUG: Renamed state_dict key: '{k}' to '{new_key}'")
-                else:
-                    # For any other keys, keep them as is (e.g., if they already match)
-                    new_state_dict[k] = v
-            
-            print(f"DEBUG: Attempting to load {len(new_state_dict)} keys into model")
-            # Attempt to load the (potentially modified) state_dict
-            try:
-                _chexnet_model.load_state_dict(new_state_dict, strict=True)
-                print("DEBUG: State dictionary loaded strictly (all keys matched after renaming).")
-            except RuntimeError as e:
-                print(f"WARNING: Strict state_dict load failed even after renaming: {e}")
-                print("Attempting non-strict load to identify remaining mismatches.")
-                missing_keys, unexpected_keys = _chexnet_model.load_state_dict(new_state_dict, strict=False)
-                if missing_keys:
-                    print(f"WARNING: Missing keys in state_dict: {missing_keys}")
-                if unexpected_keys:
-                    print(f"WARNING: Unexpected keys in state_dict: {unexpected_keys}")
-                print("DEBUG: State dictionary loaded non-strictly.")
-
-            _chexnet_model.eval() # Set model to evaluation mode
-            print("PyTorch CheXNet model loaded successfully.")
+            model, _preloaded_model = _preloaded_model, None
+            if model is None:
+                model = _read_model(model_path)
+            if isinstance(model, torch.jit.ScriptModule):
+                _chexnet_model = _prepare_torchscript(model)
+                logger.info("PyTorch CheXNet model loaded successfully.")
+                return _chexnet_model
+
+            _chexnet_model = model
+
+            assert not any(m.training for m in _chexnet_model.modules()), "CheXNet must be in eval mode for inference"
+            _chexnet_model = _chexnet_model.to(DEVICE, memory_format=MEMORY_FORMAT)
+            logger.debug("Model placed on device: %s (%s)", DEVICE, MEMORY_FORMAT)
+            if USE_IPEX:
+                logger.debug("Optimising model with Intel Extension for PyTorch (bf16=%s)", USE_BF16)
+                _chexnet_model = ipex.optimize(_chexnet_model, dtype=torch.bfloat16 if USE_BF16 else torch.float32, level='O1')
+            elif USE_BF16:
+                logger.debug("CPU supports AVX512-BF16, converting model weights to bfloat16")
+                _chexnet_model = _chexnet_model.to(torch.bfloat16)
+            if CHEXNET_BACKEND == 'onnx':
+                _chexnet_model = _load_onnx_session(_chexnet_model, model_path)
+                _warm_up(_chexnet_model)
+            elif CHEXNET_BACKEND == 'tensorrt':
+                _chexnet_model = _build_tensorrt_engine(_chexnet_model, model_path)
+                _warm_up(_chexnet_model)
+            elif CHEXNET_BACKEND == 'openvino':
+                _chexnet_model = _load_openvino_model(_chexnet_model, model_path)
+                _warm_up(_chexnet_model)
+            elif CHEXNET_COMPILE:
+                _chexnet_model = _compile_model(_chexnet_model)
+            else:
+                _chexnet_model = _freeze_to_torchscript(_chexnet_model, model_path)
+            logger.info("PyTorch CheXNet model loaded successfully.")
 
         except Exception as e:
-            print(f"ERROR: Failed to load PyTorch model from {model_path}. Error: {type(e).__name__}: {e}")
-            import traceback
-            traceback.print_exc()
+            # Don't leave a half-built model behind: the next call (e.g. the lazy retry on /predict) starts over
+            _chexnet_model = None
+            logger.exception("Failed to load PyTorch model from %s. Error: %s: %s", model_path, type(e).__name__, e)
             raise RuntimeError(f"Failed to load AI model: {type(e).__name__}: {e}")
     return _chexnet_model
 
-def predict_image(model: CheXNet, image_tensor: torch.Tensor) -> tuple[dict, bool]:
+# Micro-batching of concurrent /predict requests (useful with threaded Gunicorn workers).
+# Requests arriving within CHEXNET_BATCH_WAIT_MS of each other share one forward pass.
+CHEXNET_BATCHING = os.getenv('CHEXNET_BATCHING', '0') == '1'
+MAX_BATCH_SIZE = int(os.getenv('CHEXNET_MAX_BATCH_SIZE', '32'))
+MAX_BATCH_WAIT_MS = float(os.getenv('CHEXNET_BATCH_WAIT_MS', '10'))
+
+class _PendingPrediction:
+    __slots__ = ('image_tensor', 'done', 'output', 'error')
+
+    def __init__(self, image_tensor: torch.Tensor):
+        self.image_tensor = image_tensor
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+class InferenceBatcher:
+    """
+    Collects single-image requests from many threads and runs them through the model as one
+    batch on a background thread, handing each caller back its own row of the output.
+    """
+    def __init__(self, model, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_BATCH_WAIT_MS):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name='chexnet-batcher', daemon=True)
+        self.worker.start()
+
+    def submit(self, image_tensor: torch.Tensor) -> torch.Tensor:
+        """Blocks until the batch containing this (1, C, H, W) tensor has run; returns its (1, num_classes) output."""
+        item = _PendingPrediction(image_tensor)
+        self.pending.put(item)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.output
+
+    def _collect_batch(self) -> list:
+        items = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    @torch.inference_mode()
+    def _run(self):
+        # Inference mode is entered once for the lifetime of the batcher thread
+        while True:
+            items = self._collect_batch()
+            try:
+                with _autocast():
+                    outputs = self.model(torch.cat([item.image_tensor for item in items], dim=0))
+                for i, item in enumerate(items):
+                    item.output = outputs[i:i + 1]
+            except Exception as e:
+                for item in items:
+                    item.error = e
+            finally:
+                for item in items:
+                    item.done.set()
+
+_batcher = None
+_batcher_pid = None
+_batcher_lock = threading.Lock()
+
+def _get_batcher(model) -> InferenceBatcher:
+    """Returns this process's batcher (threads don't survive fork, so each Gunicorn worker starts its own)."""
+    global _batcher, _batcher_pid
+    batcher = _batcher
+    if batcher is not None and _batcher_pid == os.getpid() and batcher.model is model:
+        return batcher
+    # Without the lock, the first concurrent requests could each start their own batcher and never share a batch
+    with _batcher_lock:
+        if _batcher is None or _batcher_pid != os.getpid() or _batcher.model is not model:
+            _batcher = InferenceBatcher(model)
+            _batcher_pid = os.getpid()
+        return _batcher
+
+@torch.inference_mode()
+def predict_image(model: CheXNet, image_tensor: torch.Tensor) -> tuple[dict, bool, str, float]:
     """
     Performs inference on a preprocessed image tensor using the loaded CheXNet model.
-    Returns a dictionary of condition probabilities and a boolean indicating if no significant finding was detected.
+    Returns a dictionary of condition probabilities, a boolean indicating if no significant finding was detected,
+    and the top condition with its probability.
     """
     if model is None:
         raise ValueError("AI model is not loaded.")
     
-    model.eval() # Ensure model is in evaluation mode
-    
-    # Convert to float32 for inference (more stable than float16 for this model)
-    image_tensor = image_tensor.float()
+    assert image_tensor.dtype == torch.float32 and image_tensor.device.type == 'cpu', \
+        "preprocess_image should return a float32 CPU tensor"
+    # Match the model's weight dtype (bfloat16 on BF16-capable CPUs); the input is already float32 otherwise
+    if INFERENCE_DTYPE != torch.float32:
+        image_tensor = image_tensor.to(INFERENCE_DTYPE)
+    image_tensor = image_tensor.contiguous(memory_format=MEMORY_FORMAT)
+    if DEVICE.type == 'cuda':
+        # Pinned host memory allows an asynchronous host-to-device copy
+        image_tensor = image_tensor.pin_memory().to(DEVICE, non_blocking=True)
     
-    with torch.no_grad(): # Disable gradient calculation for inference
-        # Run inference with CPU (explicit)
-        with torch.inference_mode():
-            output = model(image_tensor.cpu())
-            # Detach output immediately to free memory
-            probabilities = output.squeeze(0).detach().cpu().numpy().tolist()
-
-    # Map probabilities to condition names
-    predictions = {CONDITIONS[i]: prob for i, prob in enumerate(probabilities)}
-
-    # Determine if there's no significant finding based on the highest probability
-    max_probability = max(predictions.values())
+    with _autocast():
+        if CHEXNET_BATCHING:
+            output = _get_batcher(model).submit(image_tensor)
+        else:
+            output = model(image_tensor)
+    # Outputs created under inference_mode carry no autograd graph, so no detach() is needed.
+    # Only GPU and bfloat16 outputs need converting; the default CPU fp32 path skips both dispatches.
+    if output.device.type != 'cpu':
+        output = output.cpu()
+    if output.dtype != torch.float32:
+        output = output.float()
+    probabilities = output.squeeze(0).numpy()
+
+    # Find the top condition and make the threshold decision on the raw array, before any Python floats exist
+    top_index = int(probabilities.argmax())
+    max_probability = float(probabilities[top_index])
     no_significant_finding = max_probability < NO_FINDING_THRESHOLD
+
+    # Map probabilities to condition names (always needed: /predict returns every class)
+    predictions = dict(zip(CONDITIONS, probabilities.tolist()))
     
-    return predictions, no_significant_finding
\ No newline at end of file
+    return predictions, no_significant_finding, CONDITIONS[top_index], max_probability
@@ -2,39 +2,230 @@ import torch
 from PIL import Image
 import numpy as np
 import os
-from torchvision import transforms
+import io
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import BinaryIO
+
+try:
+    import numba
+except ImportError: # Numba is optional; without it the normalization runs as vectorized NumPy
+    numba = None
+
+try:
+    import cv2
+except ImportError: # OpenCV is optional; without it the resize is done by PIL
+    cv2 = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_GRAY, TJCS_GRAY, TJCS_CMYK, TJCS_YCCK
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError): # PyTurboJPEG (and the libturbojpeg library, whose absence raises RuntimeError) are optional; PIL decodes JPEGs without them
+    _turbojpeg = None
+
+logger = logging.getLogger(__name__)
+
+JPEG_MAGIC = b'\xff\xd8\xff'
 
 # ImageNet mean and standard deviation for normalization
 IMAGENET_MEAN = [0.485, 0.456, 0.406]
 IMAGENET_STD = [0.229, 0.224, 0.225]
 
-def preprocess_image(image_path: str) -> torch.Tensor:
+RESIZE_SIZE = 256
+CROP_SIZE = 224
+
+# ToTensor's 1/255 scaling and Normalize's (x - mean) / std folded into one multiply-add per channel
+NORMALIZE_SCALE = np.array([1.0 / (255.0 * s) for s in IMAGENET_STD], dtype=np.float32)
+NORMALIZE_BIAS = np.array([-m / s for m, s in zip(IMAGENET_MEAN, IMAGENET_STD)], dtype=np.float32)
+
+# Preprocessed tensors cached by hash of the image bytes (in-process LRU, plus an optional
+# on-disk cache shared between workers when PREPROCESS_CACHE_DIR is set). Each entry is ~600 KB
+# and every worker holds its own LRU, so keep the in-memory size small.
+PREPROCESS_CACHE_SIZE = int(os.getenv('PREPROCESS_CACHE_SIZE', '32'))
+PREPROCESS_CACHE_DIR = os.getenv('PREPROCESS_CACHE_DIR', '')
+# Preprocessing parameters are part of the key so changing them never serves stale tensors
+_CACHE_KEY_PREFIX = f"{RESIZE_SIZE}:{CROP_SIZE}:{IMAGENET_MEAN}:{IMAGENET_STD}:".encode('utf-8')
+_tensor_cache = OrderedDict()
+_tensor_cache_lock = threading.Lock()
+
+# The kernels are compiled without parallel=True: three channels give too little work to split, and
+# Numba's default workqueue threading layer aborts when gthread workers call a parallel kernel concurrently
+if numba is not None:
+    @numba.njit(fastmath=True, cache=True)
+    def _crop_normalize_chw(src, top, left, scale, bias, dst):
+        """Crops, scales, normalizes and transposes an HxWx3 uint8 image into a 3xHxW float32 buffer in one pass."""
+        for c in range(3):
+            for y in range(dst.shape[1]):
+                for x in range(dst.shape[2]):
+                    dst[c, y, x] = src[top + y, left + x, c] * scale[c] + bias[c]
+
+    @numba.njit(fastmath=True, cache=True)
+    def _crop_normalize_gray_chw(src, top, left, scale, bias, dst):
+        """Like _crop_normalize_chw, but reads a single HxW grayscale plane into all three output channels."""
+        for c in range(3):
+            for y in range(dst.shape[1]):
+                for x in range(dst.shape[2]):
+                    dst[c, y, x] = src[top + y, left + x] * scale[c] + bias[c]
+
+def _decode_image(image_bytes: bytes) -> Image.Image | np.ndarray:
     """
-    Loads an image from the given path, applies CheXNet-specific preprocessing
-    (resize to 256, center crop to 224, convert to tensor, normalize),
-    and outputs a PyTorch tensor.
+    Decodes the image to RGB, or to a single 8-bit plane when it is grayscale (most chest X-rays),
+    so the resize only touches one channel; the three model channels are filled from that plane
+    during normalization. JPEGs (detected by magic bytes, since uploads arrive as streams) go
+    through libjpeg-turbo's SIMD decoder when available and come back as an HxW or HxWx3 array;
+    everything else, including CMYK/YCCK JPEGs and JPEGs libjpeg-turbo rejects, is decoded by PIL.
+    JPEGs larger than Image.MAX_IMAGE_PIXELS also go to PIL, so its decompression-bomb check
+    rejects them before anything is decoded.
     """
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"Image file not found at: {image_path}")
+    if _turbojpeg is not None and image_bytes.startswith(JPEG_MAGIC):
+        try:
+            width, height, _, colorspace = _turbojpeg.decode_header(image_bytes)
+            within_limit = Image.MAX_IMAGE_PIXELS is None or width * height <= Image.MAX_IMAGE_PIXELS
+            if within_limit and colorspace == TJCS_GRAY:
+                return _turbojpeg.decode(image_bytes, pixel_format=TJPF_GRAY)[:, :, 0]
+            if within_limit and colorspace not in (TJCS_CMYK, TJCS_YCCK):
+                return _turbojpeg.decode(image_bytes, pixel_format=TJPF_RGB)
+        except Exception as e:
+            logger.debug("libjpeg-turbo could not decode the image, falling back to PIL: %s", e)
+    img = Image.open(io.BytesIO(image_bytes))
+    if img.mode == 'L':
+        return img
+    return img.convert('RGB') # Ensure 3 channels
 
-    img = Image.open(image_path).convert('RGB') # Ensure 3 channels
-    print(f"DEBUG: Original image loaded. Mode: {img.mode}, Size: {img.size}")
+def _resize_shorter_edge(img: Image.Image | np.ndarray, size: int) -> np.ndarray:
+    """
+    Resizes so the smaller edge equals size, matching transforms.Resize(size), and returns
+    an HxW (grayscale) or HxWx3 uint8 array. Uses OpenCV's SIMD resize when available (INTER_AREA when shrinking,
+    which is antialiased like PIL's bilinear), otherwise PIL.
+    """
+    if isinstance(img, np.ndarray):
+        height, width = img.shape[:2]
+    else:
+        width, height = img.size
+    if width <= height:
+        new_width, new_height = size, int(size * height / width)
+    else:
+        new_width, new_height = int(size * width / height), size
 
-    # Define PyTorch transforms with the specified sequence
-    preprocess = transforms.Compose([
-        transforms.Resize(256), # Resize the smaller edge to 256
-        transforms.CenterCrop(224), # Crop the center 224x224
-        transforms.ToTensor(), # Converts PIL Image to FloatTensor and scales to [0, 1]
-        transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
-    ])
-    
-    img_tensor = preprocess(img)
-    print(f"DEBUG: Image preprocessed. PyTorch tensor shape: {img_tensor.shape}, Dtype: {img_tensor.dtype}")
-    print(f"DEBUG: Image tensor scaled to [0, 1] (after ToTensor). Min: {torch.min(img_tensor).item()}, Max: {torch.max(img_tensor).item()}")
-    print(f"DEBUG: Image normalized with ImageNet mean/std. Min: {torch.min(img_tensor).item()}, Max: {torch.max(img_tensor).item()}, Mean: {torch.mean(img_tensor).item()}, Std: {torch.std(img_tensor).item()}")
+    if cv2 is not None:
+        interpolation = cv2.INTER_AREA if new_width < width else cv2.INTER_LINEAR
+        return cv2.resize(np.asarray(img), (new_width, new_height), interpolation=interpolation)
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+    return np.asarray(img.resize((new_width, new_height), Image.BILINEAR), dtype=np.uint8)
+
+def _fused_preprocess(img: Image.Image | np.ndarray) -> torch.Tensor:
+    """
+    Equivalent to Resize(256) -> CenterCrop(224) -> ToTensor() -> Normalize(mean, std), but the crop,
+    1/255 scaling, normalization and HWC->CHW transpose happen in a single pass over the resized
+    image (one Numba kernel, or one multiply-add per channel plane with NumPy).
+    A grayscale image gives the same result as its RGB conversion, with each channel normalized
+    from the one resized plane.
+    """
+    resized = _resize_shorter_edge(img, RESIZE_SIZE)
+    height, width = resized.shape[:2]
+    top = int(round((height - CROP_SIZE) / 2.0))
+    left = int(round((width - CROP_SIZE) / 2.0))
+
+    grayscale = resized.ndim == 2
+    out = np.empty((3, CROP_SIZE, CROP_SIZE), dtype=np.float32)
+    if numba is not None:
+        kernel = _crop_normalize_gray_chw if grayscale else _crop_normalize_chw
+        kernel(resized, top, left, NORMALIZE_SCALE, NORMALIZE_BIAS, out)
+    else:
+        crop = resized[top:top + CROP_SIZE, left:left + CROP_SIZE]
+        for c in range(3):
+            np.multiply(crop if grayscale else crop[:, :, c], NORMALIZE_SCALE[c], out=out[c])
+            out[c] += NORMALIZE_BIAS[c]
+    return torch.from_numpy(out)
+
+def _decode_and_preprocess(image_bytes: bytes) -> torch.Tensor:
+    """Decodes the image bytes and runs the CheXNet preprocessing, returning a (1, 3, 224, 224) tensor."""
+    img = _decode_image(image_bytes)
+    logger.debug("Original image loaded. Type: %s, Shape/Size: %s", type(img).__name__, getattr(img, 'shape', None) or img.size)
+
+    img_tensor = _fused_preprocess(img)
+    logger.debug("Image preprocessed. PyTorch tensor shape: %s, Dtype: %s", img_tensor.shape, img_tensor.dtype)
+    # The statistics are full reductions over the tensor, so only compute them when debug logging is on
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Image normalized with ImageNet mean/std. Min: %s, Max: %s, Mean: %s, Std: %s", torch.min(img_tensor).item(), torch.max(img_tensor).item(), torch.mean(img_tensor).item(), torch.std(img_tensor).item())
 
     # Add a batch dimension: (C, H, W) -> (1, C, H, W)
     img_tensor = img_tensor.unsqueeze(0)
-    print(f"DEBUG: Image tensor expanded with batch dimension. Final shape: {img_tensor.shape}, Dtype: {img_tensor.dtype}")
+    logger.debug("Image tensor expanded with batch dimension. Final shape: %s, Dtype: %s", img_tensor.shape, img_tensor.dtype)
     
-    return img_tensor
\ No newline at end of file
+    return img_tensor
+
+def _get_cached_tensor(key: str) -> torch.Tensor | None:
+    """Looks the key up in the in-process LRU, then in the optional on-disk cache."""
+    with _tensor_cache_lock:
+        img_tensor = _tensor_cache.get(key)
+        if img_tensor is not None:
+            _tensor_cache.move_to_end(key)
+            return img_tensor
+
+    if PREPROCESS_CACHE_DIR:
+        cache_path = os.path.join(PREPROCESS_CACHE_DIR, f"{key}.pt")
+        if os.path.exists(cache_path):
+            try:
+                img_tensor = torch.load(cache_path, weights_only=True)
+            except Exception as e:
+                # A corrupt entry is a miss; preprocessing the image again overwrites it
+                logger.warning("Ignoring unreadable preprocessed tensor %s: %s", cache_path, e)
+                return None
+            _store_in_memory(key, img_tensor)
+            return img_tensor
+    return None
+
+def _store_in_memory(key: str, img_tensor: torch.Tensor) -> None:
+    with _tensor_cache_lock:
+        _tensor_cache[key] = img_tensor
+        _tensor_cache.move_to_end(key)
+        while len(_tensor_cache) > PREPROCESS_CACHE_SIZE:
+            _tensor_cache.popitem(last=False)
+
+def _cache_tensor(key: str, img_tensor: torch.Tensor) -> None:
+    _store_in_memory(key, img_tensor)
+    if PREPROCESS_CACHE_DIR:
+        cache_path = os.path.join(PREPROCESS_CACHE_DIR, f"{key}.pt")
+        # Write to a temporary file first so other workers never read a partial tensor
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(PREPROCESS_CACHE_DIR, exist_ok=True)
+            torch.save(img_tensor, tmp_path)
+            os.replace(tmp_path, cache_path)
+        except (OSError, RuntimeError) as e:
+            # torch.save reports unwritable paths as RuntimeError; the cache is optional either way
+            logger.warning("Failed to write preprocessed tensor to disk cache: %s", e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def preprocess_image(image_file: str | BinaryIO) -> torch.Tensor:
+    """
+    Loads an image from a path or a binary file-like object (e.g. an upload stream),
+    applies CheXNet-specific preprocessing (resize to 256, center crop to 224,
+    convert to tensor, normalize), and outputs a PyTorch tensor.
+    Results are cached by a hash of the image bytes, so re-analysing the same image skips
+    decoding and preprocessing. Callers must not modify the returned tensor in place.
+    """
+    if isinstance(image_file, str):
+        if not os.path.exists(image_file):
+            raise FileNotFoundError(f"Image file not found at: {image_file}")
+        with open(image_file, 'rb') as f:
+            image_bytes = f.read()
+    else:
+        image_bytes = image_file.read()
+
+    cache_key = hashlib.sha256(_CACHE_KEY_PREFIX + image_bytes).hexdigest()
+    img_tensor = _get_cached_tensor(cache_key)
+    if img_tensor is not None:
+        logger.debug("Preprocessed tensor cache hit for %s", cache_key[:12])
+        return img_tensor
+
+    img_tensor = _decode_and_preprocess(image_bytes)
+    _cache_tensor(cache_key, img_tensor)
+    return img_tensor
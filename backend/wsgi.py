@@ -0,0 +1,21 @@
+"""
+WSGI entry point for Gunicorn (see gunicorn.conf.py).
+
+With preload_app enabled this module is imported once in the Gunicorn master, which reads the
+CheXNet weights a single time so every forked worker starts from them copy-on-write. Each worker
+then finishes loading the model (device placement, runtime sessions, warm-up) in gunicorn.conf.py's
+post_worker_init hook, before it accepts requests, instead of on its first /predict request.
+"""
+import os
+import logging
+
+from app import app
+from model import preload_model
+
+# Set PRELOAD_MODEL=0 to fall back to lazy loading on the first prediction request
+if os.getenv('PRELOAD_MODEL', '1') == '1':
+    try:
+        preload_model(app.config['MODEL_PATH'])
+    except Exception as e:
+        # Workers retry the full load themselves, so a bad model path doesn't stop the server from starting
+        logging.getLogger(__name__).error("Failed to preload AI model: %s", e)